@@ -4,7 +4,10 @@ import logging
 import re
 import threading
 import unicodedata
+from bisect import bisect_right
+from collections import OrderedDict
 from enum import Enum
+from functools import lru_cache
 from itertools import filterfalse
 from operator import itemgetter
 
@@ -14,6 +17,7 @@ import dbus.service
 import Xlib.X
 import Xlib.Xatom
 import Xlib.display
+import Xlib.error
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +26,55 @@ logger = logging.getLogger(__name__)
 DBUSMENU_IFACE = "com.canonical.dbusmenu"
 KRUNNER1_IFACE = "org.kde.krunner1"
 
+# Length, in 32-bit units, of the first request for a window property value.
+FULL_PROPERTY_SIZEHINT = 64
+
+# Names shown for dbusmenu shortcut keys, when different from their own.
+SHORTCUT_KEY_NAMES = {
+    "Control": "Ctrl"
+}
+
+# Maximum number of menus kept loaded, for switching back to recent windows.
+MENU_CACHE_SIZE = 8
+# Maximum number of query words whose scores are kept for each menu.
+QUERY_WORD_CACHE_SIZE = 1000
+# Maximum number of menu labels whose words are kept, for reloading menus.
+LABEL_WORDS_CACHE_SIZE = 10000
+
+_NON_WORD_RE = re.compile(r'\W+')
+_WORD_RE = re.compile(r'\w+')
+
+
+def _normalize_match_text(s):
+    try:
+        s.encode('ascii')
+    except UnicodeEncodeError:
+        # ASCII text is left unchanged by NFKD and has no combining
+        # characters, so only other text needs this step.
+        s = "".join(filterfalse(unicodedata.combining,
+                                unicodedata.normalize('NFKD', s)))
+    return s.lower()
+
+
+def _prepare_match_text(s):
+    s = _normalize_match_text(s)
+    s = _NON_WORD_RE.sub(' ', s)
+    s = s.strip()
+    return s
+
+
+def _get_match_words(texts):
+    # Normalize all texts in a single pass, joined with a character that
+    # D-Bus strings cannot contain.
+    texts = _normalize_match_text("\0".join(texts))
+    return [_WORD_RE.findall(s) for s in texts.split("\0")]
+
+
+@lru_cache(maxsize=512)
+def _get_query_words(query):
+    # KRunner sends the whole query again on every keystroke.
+    return tuple(_prepare_match_text(query).split())
+
 
 class AppmenuXWindowInfo(object):
     """
@@ -47,7 +100,10 @@ class AppmenuXWindowInfo(object):
             r = window.get_property(atom, property_type, offset, length)
         else:
             assert offset == 0
-            r = window.get_full_property(atom, property_type)
+            # Ask for enough data up front that D-Bus names and object paths
+            # fit in a single request.
+            r = window.get_full_property(atom, property_type,
+                                         sizehint=FULL_PROPERTY_SIZEHINT)
 
         if r is None:
             return None
@@ -131,7 +187,9 @@ class Runner(dbus.service.Object):
         super().__init__(*args, **kwargs)
         self._window_info = AppmenuXWindowInfo()
         self._active_appmenu = (None, None)
-        self._menu_entries = None
+        self._menu = None
+        self._menu_cache = OrderedDict()
+        self._label_words_cache = {}
         for signal_name in 'ItemsPropertiesUpdated', 'LayoutUpdated':
             self.connection.add_signal_receiver(self._reset_appmenu,
                                                 dbus_interface=DBUSMENU_IFACE,
@@ -141,17 +199,23 @@ class Runner(dbus.service.Object):
                                                 path_keyword='path')
 
     def _reset_appmenu(self, *args, sender, path, signal):
+        if self._menu_cache.pop((sender, path), None) is not None:
+            logger.debug("dropping cached appmenu %s %s: %s",
+                         sender, path, signal)
         if (sender, path) == self._active_appmenu:
             logger.debug("resetting appmenu: %s", signal)
-            self._menu_entries = None
+            self._menu = None
+
+    @lru_cache(maxsize=16)
+    def _get_dbusmenu(self, service, objpath):
+        obj = self.connection.get_object(service, objpath, introspect=False)
+        return dbus.Interface(obj, DBUSMENU_IFACE)
 
     @staticmethod
     def _format_shortcut_key(key):
         if len(key) == 1:
-            key = key.upper()
-        elif key == "Control":
-            key = "Ctrl"
-        return key
+            return key.upper()
+        return SHORTCUT_KEY_NAMES.get(key, key)
 
     def _make_menu_entry(self, id_, props):
         entry = {
@@ -167,15 +231,48 @@ class Runner(dbus.service.Object):
                                              shortcut[0]))
         return entry
 
-    def _get_dbusmenu_entries(self, dbusmenu, id_=0, props=None, children=None,
-                              ancestors=None):
-        if id_ == 0 or (props.get('children-display') and not children):
-            if id_ != 0:
+    @classmethod
+    def _get_unpopulated_submenus(cls, id_, props, children):
+        if children:
+            for child in children:
+                yield from cls._get_unpopulated_submenus(*child)
+        elif id_ != 0 and props.get('children-display'):
+            yield id_
+
+    @staticmethod
+    def _about_to_show(dbusmenu, ids):
+        try:
+            dbusmenu.AboutToShowGroup(ids)
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != "org.freedesktop.DBus.Error.UnknownMethod":
+                raise
+            for id_ in ids:
                 dbusmenu.AboutToShow(id_)
-            props_wanted = ["label", "icon-name", "children-display",
-                            "shortcut"]
-            rev, (id_, props, children) = dbusmenu.GetLayout(id_, -1,
-                                                             props_wanted)
+
+    def _get_dbusmenu_layout(self, dbusmenu):
+        """
+
+        Get the whole menu layout, populating submenus that are only filled
+        in when they are about to be shown.
+
+        Each round of submenus is populated in one batch and the layout is
+        fetched again, so the number of D-Bus calls depends on how deeply
+        these submenus are nested rather than on how many there are.
+
+        """
+        props_wanted = ["label", "icon-name", "children-display", "shortcut"]
+        shown = set()
+        while True:
+            rev, layout = dbusmenu.GetLayout(0, -1, props_wanted)
+            ids = [id_ for id_ in self._get_unpopulated_submenus(*layout)
+                   if id_ not in shown]
+            if not ids:
+                return layout
+            logger.debug("populating %s submenus", len(ids))
+            self._about_to_show(dbusmenu, ids)
+            shown.update(ids)
+
+    def _get_dbusmenu_entries(self, id_, props, children, ancestors=None):
         if ancestors is None:
             ancestors = []
         entry = self._make_menu_entry(id_, props)
@@ -184,8 +281,7 @@ class Runner(dbus.service.Object):
                 ancestors = ancestors[:]
                 ancestors.append(entry)
             for child in children:
-                yield from self._get_dbusmenu_entries(dbusmenu, *child,
-                                                      ancestors)
+                yield from self._get_dbusmenu_entries(*child, ancestors)
         elif entry["label"]:
             entry["ancestors"] = ancestors
             yield entry
@@ -198,48 +294,107 @@ class Runner(dbus.service.Object):
         service, objpath = self._active_appmenu
         if service is None or objpath is None:
             logger.debug("no active appmenu")
-            self._menu_entries = None
+            self._menu = None
             return
 
-        logger.debug("loading appmenu from %s %s", service, objpath)
-        obj = self.connection.get_object(service, objpath, introspect=False)
-        dbusmenu = dbus.Interface(obj, DBUSMENU_IFACE)
-
-        self._menu_entries = []
-        for entry in self._get_dbusmenu_entries(dbusmenu):
-            label = self._format_label(entry["label"])
-            ancestor_labels = list(map(self._format_label,
-                                       map(itemgetter('label'),
-                                           entry["ancestors"])))
+        try:
+            menu = self._menu_cache.pop(self._active_appmenu)
+        except KeyError:
+            menu = self._read_menu(service, objpath)
+        else:
+            logger.debug("using cached appmenu from %s %s", service, objpath)
+        self._menu_cache[self._active_appmenu] = menu
+        while len(self._menu_cache) > MENU_CACHE_SIZE:
+            self._menu_cache.popitem(last=False)
+        self._menu = menu
 
-            ancestor_ids = list(map(itemgetter('id'), entry["ancestors"]))
+    def _read_menu(self, service, objpath):
+        logger.debug("loading appmenu from %s %s", service, objpath)
+        dbusmenu = self._get_dbusmenu(service, objpath)
+
+        layout = self._get_dbusmenu_layout(dbusmenu)
+        entries = []
+        match_labels = []
+        for entry in self._get_dbusmenu_entries(*layout):
+            ancestors = entry["ancestors"]
+            labels = [self._format_label(ancestor["label"])
+                      for ancestor in ancestors]
+            labels.append(self._format_label(entry["label"]))
+
+            ancestor_ids = ','.join([str(ancestor["id"])
+                                     for ancestor in ancestors])
             action_id = "{}|{}|{}|{}".format(service,
                                              objpath,
-                                             ','.join(map(str, ancestor_ids)),
+                                             ancestor_ids,
                                              entry["id"])
             entry.update({
                 "action_id": action_id,
-                "action_text": " » ".join(ancestor_labels + [label]),
-                "match_data": self._create_match_data(ancestor_labels, label)
+                "action_text": " » ".join(labels)
             })
-            self._menu_entries.append(entry)
-        logger.debug("appmenu has %s entries", len(self._menu_entries))
+            entries.append(entry)
+            match_labels.append(labels)
+        logger.debug("appmenu has %s entries", len(entries))
+
+        label_words = self._get_label_words(set().union(*match_labels))
+        entries_words = [set().union(*map(label_words.__getitem__, labels))
+                         for labels in match_labels]
+
+        # All distinct words in the menu, so that each query word is only
+        # compared once with each of them, regardless of how many entries
+        # (e.g. siblings sharing ancestor labels) contain the same word.
+        # They are sorted by length, so that only the words long enough to
+        # contain a query word need to be searched.
+        words = sorted(set().union(*entries_words), key=len)
+        words_lengths = [len(word) for word in words]
+        # The same words joined in a single string, with the offset where each
+        # one starts, so a query word can be searched in all of them at once.
+        words_offsets = []
+        offset = 0
+        for word in words:
+            words_offsets.append(offset)
+            offset += len(word) + 1
+
+        # Entries refer to their words by index in the list above, which are
+        # cheaper to hash and compare than the words themselves. They are kept
+        # apart from the entries, which are only needed for the results.
+        word_ids = {word: i for i, word in enumerate(words)}
+        entry_word_ids = []
+        # For each word, the indexes of the entries containing it.
+        word_entries = [[] for word in words]
+        for i, entry_words in enumerate(entries_words):
+            ids = frozenset(map(word_ids.__getitem__, entry_words))
+            entry_word_ids.append(ids)
+            for word_id in ids:
+                word_entries[word_id].append(i)
 
-    def _create_match_data(self, ancestor_labels, label):
-        labels = ancestor_labels + [label]
-        words = set(self._prepare_match_text(' '.join(labels)).split())
         return {
-            "words": words
+            "entries": entries,
+            "entry_word_ids": entry_word_ids,
+            "word_ids": word_ids,
+            "word_entries": word_entries,
+            "words_lengths": words_lengths,
+            "words_text": "\n".join(words),
+            "words_offsets": words_offsets,
+            "query_word_scores": {}
         }
 
-    @staticmethod
-    def _prepare_match_text(s):
-        s = "".join(filterfalse(unicodedata.combining,
-                                unicodedata.normalize('NFKD', s)))
-        s = s.lower()
-        s = re.sub(r'\W+', ' ', s)
-        s = s.strip()
-        return s
+    def _get_label_words(self, labels):
+        """
+
+        Get a mapping of each of the given labels to its words.
+
+        Applications often send LayoutUpdated while only a few labels have
+        changed, so the words of labels already seen are kept and only new
+        labels are tokenized when the menu is read again.
+
+        """
+        cache = self._label_words_cache
+        new_labels = [label for label in labels if label not in cache]
+        if len(cache) + len(new_labels) > LABEL_WORDS_CACHE_SIZE:
+            cache.clear()
+            new_labels = list(labels)
+        cache.update(zip(new_labels, _get_match_words(new_labels)))
+        return cache
 
     def _make_action(self, entry, type_, relevance):
         properties = {}
@@ -252,79 +407,140 @@ class Runner(dbus.service.Object):
                 relevance,
                 properties)
 
+    def _match_menu_words(self, qword):
+        # The query is sent again on every keystroke, so most of its words
+        # have already been matched against the menu.
+        cache = self._menu["query_word_scores"]
+        try:
+            return cache[qword]
+        except KeyError:
+            pass
+
+        lengths = self._menu["words_lengths"]
+        offsets = self._menu["words_offsets"]
+        text = self._menu["words_text"]
+        qword_length = len(qword)
+        scores = {}
+        # A word of the same length as the query word only contains it if
+        # they are equal, which is a dictionary lookup, and shorter words
+        # cannot contain it at all.
+        i = self._menu["word_ids"].get(qword)
+        if i is not None:
+            scores[i] = 1.0
+        start = bisect_right(lengths, qword_length)
+        if start < len(offsets):
+            pos = text.find(qword, offsets[start])
+        else:
+            pos = -1
+        while pos != -1:
+            # Hits are found in order, so the word is at or after the
+            # previous one.
+            i = bisect_right(offsets, pos, start) - 1
+            scores[i] = qword_length / lengths[i]
+            # Words are separated by newlines, which query words never
+            # contain, so skip straight to the next word.
+            start = i + 1
+            pos = text.find(qword, offsets[i] + lengths[i] + 1)
+
+        if len(cache) >= QUERY_WORD_CACHE_SIZE:
+            cache.clear()
+        cache[qword] = scores
+        return scores
+
     @staticmethod
-    def _match_words(query_words, label_words):
+    def _match_words(query_word_scores, label_word_ids):
         scores = 0
-        for qword in query_words:
-            score = 0
-            for lword in label_words:
-                if qword in lword:
-                    new_score = len(qword) / len(lword)
-                    score = max(score, new_score)
-                    if score == 1:
-                        break
+        for word_scores in query_word_scores:
+            matched_words = label_word_ids.intersection(word_scores)
             # If a query word fails to match any label words, give this match a
             # final score 0.
-            if score == 0:
+            if not matched_words:
                 return 0
 
-            scores += score
-        return scores / len(query_words)
+            scores += max(map(word_scores.__getitem__, matched_words))
+        return scores / len(query_word_scores)
 
-    def is_enabled(self, entry, cache=None):
-        if not entry["ancestors"]:
-            return True
+    def get_disabled(self, entries):
+        """
 
-        id_ = entry["id"]
-        if cache is not None:
-            try:
-                return cache[id_]
-            except KeyError:
-                pass
+        Get the ids of the given entries that are disabled.
+
+        All parent menus are sent AboutToShow in one batch, so that they can
+        update their items, and the items are then queried together.
 
-        obj = self.connection.get_object(*self._active_appmenu,
-                                         introspect=False)
-        dbusmenu = dbus.Interface(obj, DBUSMENU_IFACE)
+        """
+        ids = [entry["id"] for entry in entries if entry["ancestors"]]
+        if not ids:
+            return set()
 
-        parent_id = entry["ancestors"][-1]["id"]
+        dbusmenu = self._get_dbusmenu(*self._active_appmenu)
+
+        parent_ids = list({entry["ancestors"][-1]["id"]
+                           for entry in entries if entry["ancestors"]})
+        self._about_to_show(dbusmenu, parent_ids)
         props_wanted = ["enabled"]
-        dbusmenu.AboutToShow(parent_id)
-        siblings = dbusmenu.GetLayout(parent_id, -1, props_wanted)[1][2]
-
-        enabled = True
-        for s_id, props, children in siblings:
-            s_enabled = props.get("enabled", True)
-            if cache is not None:
-                cache[s_id] = s_enabled
-            if s_id == id_:
-                enabled = s_enabled
-                if cache is None:
-                    break
-
-        return enabled
-
-    def match(self, query):
-        if not self._menu_entries:
+        return {id_ for id_, props in dbusmenu.GetGroupProperties(ids,
+                                                                  props_wanted)
+                if not props.get("enabled", True)}
+
+    def match(self, query, limit):
+        if not self._menu or not self._menu["entries"]:
             logger.debug("appmenu not available")
             return []
 
-        query = self._prepare_match_text(query)
-        query_words = query.split()
+        query_words = _get_query_words(query)
 
-        enabled_cache = {}
-        for entry in self._menu_entries:
-            md = entry["match_data"]
-            score = self._match_words(query_words, md["words"])
-            logger.debug("query match %r on %r, score=%r",
-                         query, md["words"], score)
+        if not query_words:
+            return []
+        # Longer query words can only be contained in fewer (and longer) menu
+        # words, so they are the quickest to search and the likeliest to have
+        # no matches at all, in which case nothing else needs to be searched.
+        query_word_scores = {}
+        for qword in sorted(set(query_words), key=len, reverse=True):
+            word_scores = self._match_menu_words(qword)
+            if not word_scores:
+                return []
+            query_word_scores[qword] = word_scores
+        query_word_scores = list(map(query_word_scores.__getitem__,
+                                     query_words))
+
+        # Only entries with a match for every query word can have a non-zero
+        # score, so find those first from the entries of the matched words.
+        word_entries = self._menu["word_entries"]
+        candidates = set.intersection(*(
+            set().union(*map(word_entries.__getitem__, word_scores))
+            for word_scores in query_word_scores
+        ))
+
+        entry_word_ids = self._menu["entry_word_ids"]
+        matches = []
+        for i in sorted(candidates):
+            score = self._match_words(query_word_scores, entry_word_ids[i])
             if score > 0:
+                matches.append((score, i))
+        # Checking if entries are enabled takes D-Bus calls, so only do it for
+        # the best matches, until enough of them have been found.
+        matches.sort(key=itemgetter(0), reverse=True)
+
+        entries = self._menu["entries"]
+        results = []
+        while matches and len(results) < limit:
+            batch = [(score, entries[i])
+                     for score, i in matches[:limit - len(results)]]
+            del matches[:len(batch)]
+            disabled = self.get_disabled([entry for score, entry in batch])
+            for score, entry in batch:
+                logger.debug("query match %r on %r, score=%r",
+                             query, entry["action_text"], score)
+                if entry["id"] in disabled:
+                    continue
+
                 if score == 1:
                     type_ = self.QueryMatchType.ExactMatch
                 else:
                     type_ = self.QueryMatchType.PossibleMatch
-
-                if self.is_enabled(entry, enabled_cache):
-                    yield self._make_action(entry, type_, score)
+                results.append(self._make_action(entry, type_, score))
+        return results
 
     @dbus.service.method(KRUNNER1_IFACE, out_signature='a(sss)')
     def Actions(self, msg):
@@ -338,17 +554,14 @@ class Runner(dbus.service.Object):
             if self._active_appmenu != active_appmenu:
                 logger.debug("active window has changed, resetting appmenu")
                 self._active_appmenu = active_appmenu
-                self._menu_entries = None
-            if self._menu_entries is None:
+                self._menu = None
+            if self._menu is None:
                 logger.debug("loading appmenu contents")
                 self.load_menu()
             if len(query) < 3:
                 return []
 
-            results = list(self.match(query))
-            results.sort(key=itemgetter(4, 3), reverse=True)
-            results = results[:10]
-            return results
+            return self.match(query, 10)
         except Exception:
             logger.exception("Error in Match()")
             raise
@@ -358,8 +571,7 @@ class Runner(dbus.service.Object):
         try:
             service, objpath, ancestors, entry_id = matchId.split('|')
             ancestors = list(map(int, ancestors.split(',')))
-            obj = self.connection.get_object(service, objpath, introspect=False)
-            dbusmenu = dbus.Interface(obj, DBUSMENU_IFACE)
+            dbusmenu = self._get_dbusmenu(service, objpath)
             # for ancestor in ancestors:
             #     dbusmenu.Event(ancestor, "opened", "", 0)
             # for ancestor in ancestors[::-1]: